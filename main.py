@@ -1,28 +1,104 @@
 import os
-from flask import Flask, render_template, redirect, url_for, request, flash, abort
+import hashlib
+import time
+import nh3
+from flask import Flask, render_template, redirect, url_for, request, flash, abort, session, make_response
 from flask_bootstrap import Bootstrap
 from flask_sqlalchemy import SQLAlchemy
-from flask_gravatar import Gravatar
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_ckeditor import CKEditor
-from functools import wraps
-from sqlalchemy import exc
-from sqlalchemy.orm import relationship
-from datetime import date
+from flask_caching import Cache
+from functools import wraps, lru_cache
+from sqlalchemy import exc, event, insert
+from sqlalchemy.orm import relationship, selectinload, raiseload, load_only
+from sqlalchemy.pool import QueuePool
+from datetime import date, datetime, timezone
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
-# ========== App, Bootstrap and ckeditor initialization. ==========
+# ========== App, Bootstrap, ckeditor and cache initialization. ==========
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
 app.config['CKEDITOR_PKG_TYPE'] = 'basic'
 ckeditor = CKEditor(app)
 Bootstrap(app)
+# Store the cache on disk, so that invalidating a post applies to all gunicorn workers.
+cache = Cache(app, config={
+    'CACHE_TYPE': 'FileSystemCache',
+    'CACHE_DIR': os.path.join(app.instance_path, 'cache')
+})
+
+
+# ========== CKEditor assets. ==========
+def render_ckeditor_script(name):
+    """
+    Function renders the CKEditor loader and config scripts for a form field.
+    :param name: The name of the CKEditorField the editor is attached to.
+    """
+    editor = app.extensions['ckeditor']
+    return editor.load() + editor.config(name=name)
+
+
+cached_ckeditor_script = lru_cache(maxsize=None)(render_ckeditor_script)
+
+
+def ckeditor_script(name):
+    """
+    Function returns the CKEditor scripts for a form field, rendered once per process
+    since they only depend on the app config.
+    :param name: The name of the CKEditorField the editor is attached to.
+    """
+    # With CSRF enabled the config embeds the user's CSRF token, so it can't be shared.
+    if app.config.get('CKEDITOR_ENABLE_CSRF'):
+        return render_ckeditor_script(name)
+    return cached_ckeditor_script(name)
+
+
+app.jinja_env.globals['ckeditor_script'] = ckeditor_script
+
+
+@app.template_filter('post_date')
+def post_date(value):
+    """
+    Function formats a post's publishing date for display, e.g. "May 20, 2023".
+    :param value: The date of the post.
+    """
+    return value.strftime("%B %d, %Y")
+
 
 # ========== DB initialization. ==========
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Keep a bounded pool of long-lived connections, so their pragmas and page cache are reused.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "poolclass": QueuePool,
+    "pool_size": 10,
+    "max_overflow": 20
+}
+# Keep loaded objects (e.g. the logged-in user) usable after a commit instead of
+# reloading them on the next attribute access. The session ends with the request.
+# Queries don't autoflush; the write handlers flush through their commit.
+db = SQLAlchemy(app, session_options={"expire_on_commit": False, "autoflush": False})
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Function tunes every new SQLite connection: WAL lets readers run while a write commits,
+    and synchronous=NORMAL avoids an fsync on every commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.close()
+
+
+with app.app_context():
+    event.listen(db.engine, "connect", set_sqlite_pragmas)
 
 
 # ========== Users table. ==========
@@ -30,8 +106,9 @@ class User(UserMixin, db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(100), unique=True, nullable=False)
+    email = db.Column(db.String(100), unique=True, nullable=False, index=True)
     password = db.Column(db.String(100), nullable=False)
+    gravatar_hash = db.Column(db.String(32))
     posts = relationship("BlogPost", back_populates="author")
     comments = relationship("Comment", back_populates="comment_author")
 
@@ -39,6 +116,14 @@ class User(UserMixin, db.Model):
         self.name = name
         self.email = email
         self.password = password
+        self.gravatar_hash = hashlib.md5(email.strip().lower().encode()).hexdigest()
+
+
+def utc_now():
+    """
+    Function returns the current time as a timezone-aware UTC datetime.
+    """
+    return datetime.now(timezone.utc)
 
 
 # ========== Blogs table. ==========
@@ -48,12 +133,13 @@ class BlogPost(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     # Create reference to the User object, the "posts" refers to the posts property in the User class.
     author = relationship("User", back_populates="posts")
-    title = db.Column(db.String(250), unique=True, nullable=False)
+    title = db.Column(db.String(250), unique=True, nullable=False, index=True)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(30), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
     comments = relationship("Comment", back_populates="parent_post")
+    updated_at = db.Column(db.DateTime, nullable=False, default=utc_now, onupdate=utc_now)
 
 
 # ========== Comment section table. ==========
@@ -62,11 +148,38 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     comment_author = relationship("User", back_populates="comments")
-    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("blog_posts.id"), index=True)
     parent_post = relationship("BlogPost", back_populates="comments")
     text = db.Column(db.Text, nullable=False)
 
 
+# ========== Password hashing. ==========
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+
+def verify_password(user, password):
+    """
+    Function checks a password against the user's stored hash.
+    Legacy pbkdf2 hashes (and outdated argon2 parameters) are rehashed on success.
+    :param user: The user trying to log in.
+    :param password: The password entered by the user.
+    """
+    if user.password.startswith("pbkdf2:"):
+        if not check_password_hash(user.password, password):
+            return False
+    else:
+        try:
+            password_hasher.verify(user.password, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not password_hasher.check_needs_rehash(user.password):
+            return True
+    # Migrate the user to the current argon2 parameters.
+    user.password = password_hasher.hash(password)
+    db.session.commit()
+    return True
+
+
 # ========== Login manager initialization. ==========
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -74,7 +187,7 @@ login_manager.init_app(app)
 
 @login_manager.user_loader
 def user_loader(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 
 # ========== Create admin-only decorator. ==========
@@ -94,16 +207,82 @@ def admin_only(f):
 # with app.app_context():
 #     db.create_all()
 
-# ========== Gravatar initialization. ==========
-gravatar = Gravatar(
-    app,
-    rating='g',
-    default='retro',
-    force_default=False,
-    force_lower=False,
-    use_ssl=False,
-    base_url=None
-)
+# ========== Query loading options. ==========
+def loader_options(*options):
+    """
+    Function returns the given loader options, adding a raiseload guard in debug mode
+    so that any relationship that is not eagerly loaded raises instead of lazy loading.
+    :param options: The eager loading options of the query.
+    """
+    if app.debug:
+        return options + (raiseload("*"),)
+    return options
+
+
+@cache.memoize(timeout=60)
+def load_post(post_id):
+    """
+    Function fetches a blog post with its author, comments and comment authors.
+    The result is cached, so callers must invalidate it after changing the post.
+    :param post_id: ID of the blog post in the db.
+    """
+    # Users only carry the columns the post page shows, so emails and password
+    # hashes never end up in the cache files.
+    return db.session.execute(
+        db.select(BlogPost)
+        .options(*loader_options(
+            selectinload(BlogPost.author).load_only(User.name, User.gravatar_hash),
+            selectinload(BlogPost.comments).selectinload(Comment.comment_author).load_only(
+                User.name, User.gravatar_hash
+            )
+        ))
+        .where(BlogPost.id == post_id)
+    ).scalar_one_or_none()
+
+
+def insert_posts(rows):
+    """
+    Function inserts blog posts with a single executemany INSERT and one commit,
+    bypassing the per-object unit of work of the session.
+    :param rows: List of dicts with the column values of each new post.
+    """
+    db.session.execute(insert(BlogPost), rows)
+    db.session.commit()
+
+
+# ========== Conditional GET responses. ==========
+def deploy_version():
+    """
+    Function fingerprints the deployed code, templates and static files by their modification times,
+    so that cached pages are invalidated by a redeploy. It's the same in every worker of a deploy.
+    """
+    paths = [os.path.join(app.root_path, name) for name in ("main.py", "forms.py")]
+    for folder in (app.template_folder, app.static_folder):
+        for root, _, files in os.walk(os.path.join(app.root_path, folder)):
+            paths.extend(os.path.join(root, name) for name in files)
+    mtimes = [(os.path.relpath(path, app.root_path), os.path.getmtime(path)) for path in paths]
+    return hashlib.md5(repr(sorted(mtimes)).encode()).hexdigest()
+
+
+DEPLOY_VERSION = deploy_version()
+
+
+def conditional_page(seed, render):
+    """
+    Function returns a page with an ETag built from the deploy version, the seed and the logged-in user.
+    If the browser already holds that version, a 304 is returned without rendering the page.
+    :param seed: Value that changes whenever the content of the page changes.
+    :param render: Callable that renders the page.
+    """
+    etag = hashlib.md5(repr((DEPLOY_VERSION, seed, current_user.get_id())).encode()).hexdigest()
+    # Pages with pending flash messages must be rendered to show them.
+    if request.method == 'GET' and not session.get('_flashes') and etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 # ========== Posts management section. ==========
@@ -112,8 +291,28 @@ def get_all_posts():
     """
     Function renders the home page with the blogs from the db.
     """
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts)
+    # The page changes whenever a post is added, edited or deleted.
+    seed = db.session.execute(
+        db.select(db.func.count(BlogPost.id), db.func.max(BlogPost.updated_at))
+    ).one()
+    # Select only the columns shown on the home page (skipping the post body)
+    # and stream the rows to the template in batches.
+    posts_query = (
+        db.select(
+            BlogPost.id,
+            BlogPost.title,
+            BlogPost.subtitle,
+            BlogPost.date,
+            User.name.label("author_name")
+        )
+        .outerjoin(BlogPost.author)
+        .order_by(BlogPost.id.desc())
+        .execution_options(yield_per=50)
+    )
+    return conditional_page(
+        tuple(seed),
+        lambda: render_template("index.html", all_posts=db.session.execute(posts_query))
+    )
 
 
 @app.route("/post/<int:index>", methods=["GET", "POST"])
@@ -122,33 +321,39 @@ def show_post(index):
     Function tries to fetch a blog from the db and render its page.
     :param index: ID of the blog post in the db.
     """
-    requested_post = BlogPost.query.get(index)
+    requested_post = load_post(index)
+    if requested_post is None:
+        return redirect(url_for('get_all_posts'))
     comment_form = CommentForm()
     if comment_form.validate_on_submit():
         if not current_user.is_authenticated:
             flash('You need to login or register to comment.')
             return redirect(url_for('login'))
 
-        # Create new comment object.
+        # Create new comment object (by IDs, as the cached post may be detached).
         new_comment = Comment(
-            text=comment_form.comment_text.data,
-            comment_author=current_user,
-            parent_post=requested_post
+            text=nh3.clean(comment_form.comment_text.data),
+            author_id=current_user.id,
+            post_id=requested_post.id
         )
         try:
             db.session.add(new_comment)
             db.session.commit()
+            cache.delete_memoized(load_post, requested_post.id)
             # Clean the comment section text.
             flash("Successfully added the comment.")
             return redirect(url_for("show_post", index=requested_post.id))
         except exc.IntegrityError:
             db.session.rollback()
-    return render_template(
+    # The page changes with post edits and new comments. The half-hour bucket keeps
+    # the CSRF token of a revalidated comment form within its one-hour lifetime.
+    seed = (requested_post.id, requested_post.updated_at, len(requested_post.comments), int(time.time() // 1800))
+    return conditional_page(seed, lambda: render_template(
         'post.html',
         post=requested_post,
         form=comment_form,
         current_user=current_user
-    )
+    ))
 
 
 @app.route("/new-post", methods=["GET", "POST"])
@@ -160,24 +365,20 @@ def new_post():
     """
     post_form = CreatePostForm()
     if request.method == 'POST' and post_form.validate_on_submit():
-        # Create new post object.
-        add_new_post = BlogPost(
-            title=post_form.title.data,
-            subtitle=post_form.subtitle.data,
-            body=post_form.body.data,
-            img_url=post_form.img_url.data,
-            author=current_user,
-            date=date.today().strftime("%B %d, %Y")
-        )
-        try:  # Try to add the new object to the db.
-            db.session.add(add_new_post)
-            db.session.commit()
+        # Create new post row.
+        add_new_post = {
+            "title": post_form.title.data,
+            "subtitle": post_form.subtitle.data,
+            "body": nh3.clean(post_form.body.data),
+            "img_url": post_form.img_url.data,
+            "author_id": current_user.id
+        }
+        try:  # Try to add the new row to the db.
+            insert_posts([add_new_post])
         except exc.IntegrityError:
             db.session.rollback()
-        # Fetch all posts in the db.
-        posts = db.session.query(BlogPost).all()
-        # Redirect to the home page with the newly updated posts.
-        return redirect(url_for('get_all_posts', all_posts=posts))
+        # Redirect to the home page, which fetches the updated posts itself.
+        return redirect(url_for('get_all_posts'))
     return render_template("make-post.html", form=post_form, is_edit=False)
 
 
@@ -189,13 +390,16 @@ def edit_post(post_id):
     :param post_id: The ID of the post that should be edited.
     """
     # Get current post
-    post = db.session.get(BlogPost, post_id)
+    post = db.session.get(BlogPost, post_id) or abort(404)
     # Populate the form with the existing post details.
     edit_form = CreatePostForm(obj=post)
     if edit_form.validate_on_submit():
         # Update the post with the data from the submitted form.
         edit_form.populate_obj(post)
+        # Sanitize the CKEditor HTML once here, so the templates can render it as is.
+        post.body = nh3.clean(post.body)
         db.session.commit()
+        cache.delete_memoized(load_post, post_id)
         return redirect(url_for('show_post', index=post.id))
     return render_template('make-post.html', form=edit_form, is_edit=True)
 
@@ -207,12 +411,13 @@ def delete_post(post_id):
     Function handles the deletion of a post from the db.
     :param post_id: The ID of the post that should be deleted.
     """
+    # Get the post that should be deleted from the db.
+    post_to_delete = db.session.get(BlogPost, post_id) or abort(404)
     try:
-        # Get the post that should be deleted from the db.
-        post_to_delete = BlogPost.query.get(post_id)
         # Try to delete the post from the db.
         db.session.delete(post_to_delete)
         db.session.commit()
+        cache.delete_memoized(load_post, post_id)
     except exc.IntegrityError:
         db.session.rollback()
     return redirect(url_for('get_all_posts'))
@@ -236,7 +441,7 @@ def register():
             new_user = User(
                 name=name,
                 email=email,
-                password=generate_password_hash(password, salt_length=8, method="pbkdf2:sha256")
+                password=password_hasher.hash(password)
             )
             db.session.add(new_user)
             db.session.commit()
@@ -269,7 +474,7 @@ def login():
             flash("Email does not exist, try again.")
             return redirect(url_for('login'))
         # Check if wrong password.
-        elif not check_password_hash(user.password, password):
+        elif not verify_password(user, password):
             flash("Incorrect password, please try again.")
             return redirect(url_for('login'))
         # Success login.
@@ -295,7 +500,7 @@ def about():
     """
     Function renders the about page.
     """
-    return render_template("about.html")
+    return conditional_page("about", lambda: render_template("about.html"))
 
 
 @app.route("/contact")
@@ -303,7 +508,7 @@ def contact():
     """
     Function renders the contact page.
     """
-    return render_template("contact.html")
+    return conditional_page("contact", lambda: render_template("contact.html"))
 
 
 if __name__ == "__main__":
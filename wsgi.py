@@ -0,0 +1,11 @@
+# Entry point for the production WSGI server (see Procfile).
+import os
+from jinja2 import FileSystemBytecodeCache
+from main import app
+
+# Production only: compile each template once and persist the bytecode across restarts.
+# Template auto-reload is already off here since the app doesn't run in debug mode.
+# The cache lives in the app's own instance folder, not in the shared temp directory.
+JINJA_CACHE_DIR = os.path.join(app.instance_path, "jinja_cache")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)